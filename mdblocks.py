@@ -17,44 +17,53 @@ Block level elements:
 # Tokenizing:
     
 import re
+from array import array
 
-block_prefixes = {
-    'fence': lambda x: x.startswith('```'),
-    'section': lambda x: x.startswith(':::'),
-    'quote': lambda x: x.startswith('>'),
-    'header': lambda x: x.startswith('#'),
-    'olist_start': lambda x: re.compile(r'[0-9]\. ').match(x),
-    'ulist_start': lambda x: re.compile(r'[-*+] ').match(x),
-    'blank': lambda x: re.compile(r' *$').match(x),
-}
+# token kinds are small integers, numbered as the groups of _CLASSIFY
 
-def classify(line):
-    for kind in block_prefixes:
-        if block_prefixes[kind](line):
-            return kind
-    return 'normal'
+NORMAL, FENCE, SECTION, QUOTE, HEADER, OLIST_START, ULIST_START, BLANK = range(8)
+
+KINDS = {'normal':NORMAL, 'fence':FENCE, 'section':SECTION, 'quote':QUOTE,
+         'header':HEADER, 'olist_start':OLIST_START, 
+         'ulist_start':ULIST_START, 'blank':BLANK}
 
-def maketoken(line):
-    # returns {kind, value}
-    return {'kind':classify(line), 'value':line}
+# the line prefixes for each kind of token, tried in order as a single
+# regex; the number of the matching group is the kind
+_CLASSIFY = re.compile(
+    rb'(?P<fence>```)'
+    rb'|(?P<section>:::)'
+    rb'|(?P<quote>>)'
+    rb'|(?P<header>#)'
+    rb'|(?P<olist_start>[0-9]\. )'
+    rb'|(?P<ulist_start>[-*+] )'
+    rb'|(?P<blank> *$)'
+    )
+
+def classify(line):
+    m = _CLASSIFY.match(line)
+    return m.lastindex if m else NORMAL
 
 def tokenize_file(fname):
-    with open(fname) as f:
-        return [maketoken(line) for line in f]
+    # returns (kinds, values), the kind of each line as an array 
+    # and the lines themselves (without line endings). The file is 
+    # read as bytes, so the lines are bytes and are never decoded
+    with open(fname, 'rb') as f:
+        values = f.read().splitlines()
+    return array('B', map(classify, values)), values
 
 # block grammar
 
-from minipeg import Grammar, MatchToken, TokenState
+from minipeg import Grammar, MatchTokenKind, MatchTokenNotKind, TokenState
 
 # make token recognizers
 
 def _is(kind):
-    # the predicate for any kind
-    return MatchToken(lambda tok: tok['kind']==kind)
+    # matches any token of the kind
+    return MatchTokenKind(KINDS[kind])
 
 def _isnot(kind):
-    # the predicate for any not kind
-    return MatchToken(lambda tok: tok['kind']!=kind)
+    # matches any token not of the kind
+    return MatchTokenNotKind(KINDS[kind])
 
 # the block level grammar itself:
 
@@ -96,7 +105,8 @@ b.paragraph = _is('normal')*1
 b.blank = _is('blank')*1
 
 if __name__ == '__main__':
-    s = TokenState(tokenize_file('README.md'))
+    kinds, values = tokenize_file('README.md')
+    s = TokenState(values, kinds)
     s2 = b(s)
     s2.ast[0].dump()
     
\ No newline at end of file
@@ -7,23 +7,23 @@ class Node:
     """a node in a parse tree
     
     Args:
-        parseobj -- the object/callable that created the node. If 
-                the parse object has a name, the node is given that name.
-        children -- the children of the node, which are themselves nodes
+        name -- the name of the node, usually the name of the parser
+                that created it
+        children -- a list of the children of the node, which are themselves 
+                nodes. The node keeps the list rather than copying it.
         
     Properties:
-        span -- a list [start, finish] which includes the spans
+        span -- a tuple (start, finish) which includes the spans
                 of all children (a span is the range of input which contains
                 the node)
     """
-    def __init__(self, parseobj, *children):
+    __slots__ = ('name', 'children', 'span')
+
+    def __init__(self, name, children):
         """init"""
-        if type(parseobj) is str:
-            self.name = parseobj
-        else:
-            self.name = getattr(parseobj, 'name', parseobj)
-        self.children = list(children)
-        self.span = [children[0].span[0], children[-1].span[1]]
+        self.name = name
+        self.children = children
+        self.span = (children[0].span[0], children[-1].span[1])
         
     def __getitem__(self, i):
         """node[i] returns the i-th child of the node"""
@@ -43,17 +43,16 @@ class Leaf(Node):
     """a leaf node in a parse tree
     
     Args:
-        parseobj -- the object/callable that created the node. If 
-                the parse object has a name, the node is given that name.
+        name -- the name of the node, usually the name of the parser
+                that created it
         leaf -- the leaf node itself, usually a string or token
-        span -- a list or tuple [start, finish] which gives the range of 
+        span -- a tuple (start, finish) which gives the range of 
                 input which contains the leaf
     """
-    def __init__(self, parseobj, leaf, span):
-        if type(parseobj) is str:
-            self.name = parseobj
-        else:
-            self.name = getattr(parseobj, 'name', parseobj)
+    __slots__ = ('leaf',)
+
+    def __init__(self, name, leaf, span):
+        self.name = name
         self.leaf = leaf
         self.span = span
     
@@ -63,7 +62,10 @@ class Leaf(Node):
 
     def dump(self, level=0, indent=4):
         """pretty print the node with indentation"""
-        print(f'{" "*level}{self.name}: "{self.leaf}"')
+        leaf = self.leaf
+        if type(leaf) is bytes:
+            leaf = leaf.decode(errors='replace')
+        print(f'{" "*level}{self.name}: "{leaf}"')
        
 
     
@@ -74,95 +76,131 @@ class ParseState:
     def __init__(self, input):
         self.input = input
         self.ast = []
+        self.memo = {} # packrat caches of memoized refs
         
-    def clone(self):
-        # clone and restore used for backtracking
-        return dict(ast=[*self.ast])
+    def mark(self):
+        # mark and rewind used for backtracking
+        return len(self.ast)
     
-    def restore(self, cloned):
-        self.ast = cloned['ast']
+    def rewind(self, m):
+        del self.ast[m:]
     
     def group(self, parseobj, oldlen):
-        # groups the tail of the ast into a node
+        # groups the tail of the ast into a node, in place
         if oldlen<0:
             n = -oldlen
         else:
             n = len(self.ast)-oldlen
         if n>0:
-            # node tagged by parseobj or name
-            children = []
-            for t in self.ast[-n:]:
-                if t.name=='seq':
-                    # anonymous sequences should be flattened
-                    children += t.children
-                else:
-                    children.append(t)
-            self.ast = self.ast[:-n]+[Node(parseobj, *children)]   
-    
-    def advance(self, n, node=False):
-        # partial implementation of advance
-        # (optionally) adds a node to the ast
-        if node != False:
-            self.ast.append(node)
+            # node tagged by parseobj's name, or by parseobj if a string
+            if type(parseobj) is str:
+                name = parseobj
+            else:
+                name = getattr(parseobj, 'name', parseobj)
+            children = self.ast[-n:]
+            if any(t.name=='seq' for t in children):
+                # anonymous sequences should be flattened
+                children = [c for t in children 
+                            for c in (t.children if t.name=='seq' else (t,))]
+            del self.ast[-n:]
+            self.ast.append(Node(name, children))
+    
+    def advance_with(self, n, node):
+        # adds a node to the ast & moves forward; the subclasses
+        # implement advance(n), which just moves forward
+        self.ast.append(node)
+        self.advance(n)
             
 # parse state
 
 class TextState(ParseState):
     """state object for text input"""
+    space = ' ' # the whitespace skipped before matches
+    
     def __init__(self, input):
         super().__init__(input)
-        self.rest = input # what's left
+        self.pos = 0 # where we are in the input
         
-    def clone(self):
-        # shallow copy of things
-        return dict(rest=self.rest, **super().clone())
+    def mark(self):
+        # records the ast length and position
+        return (len(self.ast), self.pos)
         
-    def restore(self, cloned):
-        # restores from a backup
-        super().restore(cloned)
-        self.rest = cloned['rest']
+    def rewind(self, m):
+        # returns to a mark
+        del self.ast[m[0]:]
+        self.pos = m[1]
 
     def match(self, patt):
-        # matches a string or regex to the start of rest
+        # matches a string or regex at the current position
         # returns the matched string on success
         if type(patt) is str:
-            return self.rest.startswith(patt) and patt
+            return self.match_str(patt)
         else: # assumed regex
-            result = patt.match(self.rest)
-            return result and result.group(0)
+            return self.match_re(patt)
     
-    def advance(self, n, node=False):
-        # moves rest forward & (optionally) adds a node to the ast
-        super().advance(n, node)
-        self.rest = self.rest[n:]
+    def match_str(self, patt):
+        # matches a string at the current position
+        return self.input.startswith(patt, self.pos) and patt
+    
+    def match_re(self, patt):
+        # matches a compiled regex at the current position
+        result = patt.match(self.input, self.pos)
+        return result and result.group(0)
+    
+    def advance(self, n):
+        # moves position forward
+        self.pos += n
         
     def position(self):
-        return len(self.input)-len(self.rest)
+        return self.pos
 
+class BytesState(TextState):
+    """state object for text input held as bytes, e.g. read from a file 
+    opened in binary mode. The literals and regexes of the grammar 
+    should then be bytes too."""
+    space = ord(' ') # indexing bytes gives ints
+    
+    def match(self, patt):
+        # matches bytes or a regex at the current position
+        # returns the matched bytes on success
+        if type(patt) is bytes:
+            return self.match_str(patt)
+        else: # assumed regex
+            return self.match_re(patt)
 
 
 class TokenState(ParseState):
-    """parsestate object for tokenized input"""
-    def __init__(self, input):
+    """parsestate object for tokenized input
+    
+    Args:
+        input -- a sequence of tokens
+        kinds -- an optional sequence, parallel to input, of the kind of 
+                each token. The kinds are what MatchTokenKind matches. If
+                omitted, they are the kind attributes of the tokens (None
+                for a token without one).
+    """
+    def __init__(self, input, kinds=None):
         super().__init__(input)
+        if kinds is None:
+            kinds = [getattr(t, 'kind', None) for t in input]
+        self.kinds = kinds
         self.cursor = 0
         
-    def clone(self):
-        # shallow copy of things
-        return dict(cursor=self.cursor, **super().clone())
+    def mark(self):
+        # records the ast length and cursor
+        return (len(self.ast), self.cursor)
         
-    def restore(self, cloned):
-        # restores from a backup
-        super().restore(cloned)
-        self.cursor = cloned['cursor']
+    def rewind(self, m):
+        # returns to a mark
+        del self.ast[m[0]:]
+        self.cursor = m[1]
 
     def match(self, predicate):
         # matches a token to a specification
         return self.cursor<len(self.input) and predicate(self.input[self.cursor])
  
-    def advance(self, n, node=False):
-        # moves cursor forward & (optionally) adds a node to the ast
-        super().advance(n, node)
+    def advance(self, n):
+        # moves cursor forward
         self.cursor += n
         
     def position(self):
@@ -185,6 +223,8 @@ class Parser:
     # Parser(state) will change the state and return it if succeeded,
     # or leave state unchanged and return False if failed.
     
+    __slots__ = () # subclasses add 'name', so Grammar has no name slot
+
     def __and__(self, other):
         # self & other, a sequence
         return Seq(self, asparser(other))
@@ -217,16 +257,32 @@ class Parser:
         self.name = name
         return self
             
+_match_cache = {} # shared parsers for the literals in expressions
+
+def _match(patt):
+    # returns the shared Match for a string literal
+    m = _match_cache.get(patt)
+    if m is None:
+        m = _match_cache[patt] = Match(patt)
+    return m
+
+_matchre_cache = {} # shared parsers for the regexes in expressions
+
+def _matchre(patt):
+    # returns the shared MatchRe for a compiled regex
+    m = _matchre_cache.get(patt)
+    if m is None:
+        m = _matchre_cache[patt] = MatchRe(patt)
+    return m
+
 def asparser(x):
-    # changes primitives into parsers for binary operators
+    # changes primitives into parsers for binary operators. Literals
+    # share one parser each, so the result shouldn't be renamed
     if isinstance(x, Parser):
         return x
-    if type(x) is str:
-        return Match(x)
-    if type(x) is bool:
-        return BoolParser(x)
-    if type(x) is re.Pattern:
-        return MatchRe(x)
+    make = _ASPARSER.get(type(x))
+    if make:
+        return make(x)
     if callable(x):
         # fingers crossed it's a parser
         return x
@@ -234,6 +290,8 @@ def asparser(x):
     
     
 class MatchToken(Parser):
+    __slots__ = ('name', 'predicate', 'save')
+
     def __init__(self, predicate, save=True):
         self.predicate = predicate
         self.name = 'token'
@@ -241,29 +299,71 @@ class MatchToken(Parser):
     
     def __call__(self, state, backtrack=False):
         if state.match(self.predicate):
-            p = state.position()
-            state.advance(1,
-                self.save and Leaf(self, state.input[p], [p, p+1]))
-            # need to save the matched token
+            if self.save:
+                # need to save the matched token
+                p = state.position()
+                state.advance_with(1, Leaf(self.name, state.input[p], (p, p+1)))
+            else:
+                state.advance(1)
             return state
         else:
             return False            
 
+class MatchTokenKind(Parser):
+    # match a token by its kind in state.kinds, without a predicate call
+    __slots__ = ('name', 'kind', 'save')
+
+    def __init__(self, kind, save=True):
+        self.kind = kind
+        self.name = 'token'
+        self.save = save
+    
+    def __call__(self, state, backtrack=False):
+        p = state.cursor
+        if p<len(state.kinds) and state.kinds[p]==self.kind:
+            if self.save:
+                state.advance_with(1, Leaf(self.name, state.input[p], (p, p+1)))
+            else:
+                state.advance(1)
+            return state
+        else:
+            return False
+
+class MatchTokenNotKind(MatchTokenKind):
+    # match any token that isn't of the given kind
+    __slots__ = ()
+
+    def __call__(self, state, backtrack=False):
+        p = state.cursor
+        if p<len(state.kinds) and state.kinds[p]!=self.kind:
+            if self.save:
+                state.advance_with(1, Leaf(self.name, state.input[p], (p, p+1)))
+            else:
+                state.advance(1)
+            return state
+        else:
+            return False
+
 class Match(Parser):
-    # match a string to the start of the state
+    # match a string at the current position of a text state
+    __slots__ = ('name', 'pattern', 'n', 'ws', 'save')
+
     def __init__(self, pattern, ws=True, save=True):
         self.pattern = pattern
+        self.n = len(pattern)
         self.name = 'literal'
         self.ws = ws
         self.save = save
         
     def __call__(self, state, backtrack=False):
         if self.ws:
-            Whitespace(state)
-        if state.match(self.pattern):
-            p = state.position()
-            state.advance(len(self.pattern),
-                self.save and Leaf(self, self.pattern, [p, p+len(self.pattern)]))
+            state.pos = _skip_ws(state.input, state.pos, state.space)
+        if state.match_str(self.pattern):
+            if self.save:
+                p = state.pos
+                state.advance_with(self.n, Leaf(self.name, self.pattern, (p, p+self.n)))
+            else:
+                state.advance(self.n)
             return state
         else:
             return False
@@ -271,108 +371,234 @@ class Match(Parser):
 import re
 
 class MatchRe(Parser):
-    # match a regex to start of state.rest
+    # match a regex at the current position of state
+    __slots__ = ('name', 're', 'ws', 'save')
+
     def __init__(self, pattern, ws=True, save=True):
-        if type(pattern) is str:
+        if type(pattern) in (str, bytes):
             pattern = re.compile(pattern)
         self.re = pattern
-        self.name = 're('+pattern.pattern+')'
+        self.name = f're({pattern.pattern})'
         self.ws = ws
         self.save = save
         
     def __call__(self, state, backtrack=False):
         if self.ws:
             # note that this way does not backtrack over the ws
-            # and requires whitespace to always succeed
-            Whitespace(state)
-        result = state.match(self.re)
+            state.pos = _skip_ws(state.input, state.pos, state.space)
+        result = state.match_re(self.re)
         if result:
-            p = state.position()
-            state.advance(len(result),
-                self.save and Leaf(self, result, [p,p+len(result)]))
+            if self.save:
+                p = state.position()
+                state.advance_with(len(result), 
+                    Leaf(self.name, result, (p, p+len(result))))
+            else:
+                state.advance(len(result))
             return state
         else:
             return False            
 
-Whitespace = MatchRe(' *', ws=False, save=False)
+def _skip_ws(s, p, space):
+    # returns the position of the first non-space in s at or after p
+    n = len(s)
+    while p<n and s[p]==space:
+        p += 1
+    return p
     
 class BoolParser(Parser):
     # a parser that's always true/false but does nothing
+    __slots__ = ('name', 'value')
+
     def __init__(self, value):
         self.value = value
+        self.name = 'bool'
         
     def __call__(self, state, backtrack=False):
         return self.value and state
+
+# what asparser makes from each type of primitive
+_ASPARSER = {str:_match, bytes:_match, bool:BoolParser, re.Pattern:_matchre}
         
 class Seq(Parser):
     # sequence of parsers with backtracking
-    def __init__(self, L, R):
-        self.L = L
-        self.R = R
+    __slots__ = ('name', 'operands', 'parsers')
+
+    def __init__(self, *parsers):
+        # operands are the parsers as written, parsers the ones to run
+        self.operands = self.parsers = parsers
         self.name = 'seq'
         
+    def flatten(self):
+        # runs the operands of anonymous sequences in this one, so that
+        # A & B & C is a single sequence of three parsers. This waits
+        # until the rules are named (the grammar's first parse, or 
+        # compile), since a sequence named later must still make a node. A sequence followed by a plain 
+        # callable is kept, because the callable may inspect the node the
+        # sequence groups.
+        flat = []
+        for i, p in enumerate(self.operands):
+            following = self.operands[i+1:i+2]
+            if (type(p) is Seq and p.name=='seq' and
+                    all(isinstance(f, Parser) for f in following)):
+                flat += p.flatten()
+            else:
+                flat.append(p)
+        self.parsers = tuple(flat)
+        return self.parsers
+        
     def __call__(self, state, backtrack=False):
         # backtrack says whether we are in a backtracking context
         if not backtrack:
-            oldstate = state.clone()
+            m = state.mark()
         astlen = len(state.ast)
-        if not (self.L(state, True) and self.R(state, True)):
-            if not backtrack:
-                state.restore(oldstate)
-            return False
-        state.group(self, astlen)
+        for p in self.parsers:
+            if not p(state, True):
+                if not backtrack:
+                    state.rewind(m)
+                return False
+        state.group(self.name, astlen)
         return state
     
 class Alt(Parser):
-    # alternative parsers
-    def __init__(self, L, R):
-        self.L = L
-        self.R = R
+    # alternative parsers, optionally with a table of the alternatives
+    # worth trying for each next character or token kind
+    __slots__ = ('name', 'operands', 'parsers', 'table', 'default', 'mode')
+
+    def __init__(self, *parsers):
+        self.operands = self.parsers = parsers
         self.name = 'alt'
+        self.table = None
+        
+    def flatten(self):
+        # runs the operands of anonymous alternatives in this one, so that
+        # A | B | C is a single choice between three parsers
+        flat = []
+        for p in self.operands:
+            if type(p) is Alt and p.name=='alt':
+                flat += p.flatten()
+            else:
+                flat.append(p)
+        self.parsers = tuple(flat)
+        return self.parsers
+        
+    def compile_first(self):
+        # builds the table of alternatives to try, keyed on the next 
+        # character (text mode) or next token kind (token mode), and 
+        # returns it. The table is None if no alternative can be ruled out.
+        firsts = [_first(p) for p in self.parsers]
+        modes = {f[0] for f in firsts if f is not None}-{None}
+        self.table = None
+        if len(modes)!=1:
+            return None
+        self.mode = modes.pop()
+        keys = set().union(*[f[1] for f in firsts if f is not None])
+        self.table = {k:tuple(p for p, f in zip(self.parsers, firsts)
+                              if f is None or k in f[1]) for k in keys}
+        self.default = tuple(p for p, f in zip(self.parsers, firsts) if f is None)
+        return self.table
         
     def __call__(self, state, backtrack=False):
         # ignore the backtrack
+        parsers = self.parsers
+        if self.table is not None:
+            if self.mode=='token':
+                p = state.cursor
+                key = state.kinds[p] if p<len(state.kinds) else None
+                parsers = self.table.get(key, self.default)
+            else:
+                p = state.pos
+                key = state.input[p] if p<len(state.input) else None
+                # a failed match may skip spaces, and so move on to a
+                # different next character; try everything at a space
+                if key!=state.space:
+                    parsers = self.table.get(key, self.default)
         astlen = len(state.ast)
-        if self.L(state) or self.R(state):
-            if self.name!='alt':
-                state.group(self, astlen)
-            return state
+        for p in parsers:
+            if p(state):
+                if self.name!='alt':
+                    state.group(self.name, astlen)
+                return state
         return False
     
 class Repeat(Parser):
+    __slots__ = ('name', 'parser', 'n')
+
     def __init__(self, p, n):
         self.parser = p
         self.n = n
         self.name = 'seq' # it is just a simple sequence
         
     def __call__(self, state, backtrack=False):
-        # do the minimum number of parses with backtracking
-        if not backtrack:
-            oldstate = state.clone()
         astlen = len(state.ast)
-        for i in range(self.n):
-            if not self.parser(state, True):
-                if not backtrack:
-                    state.restore(oldstate)
-                return False
+        if self.n:
+            # do the minimum number of parses with backtracking; only 
+            # these can fail, so only they need a mark
+            if not backtrack:
+                m = state.mark()
+            for i in range(self.n):
+                if not self.parser(state, True):
+                    if not backtrack:
+                        state.rewind(m)
+                    return False
         # do zero or more parses, each of which looks after its
-        # own backtrack
+        # own backtrack. The last one failing just ends the repeat.
         while self.parser(state):
             pass
-        state.group(self, astlen)
+        state.group(self.name, astlen)
         return state
     
+def _memo_call(ref, parser, state, backtrack):
+    # calls parser, the body of ref, through the packrat cache of ref.
+    # each memoized ref has its own cache in the state, keyed
+    # on the start position. A failure is cached with the position the
+    # parser left (e.g. past spaces), which can differ with backtrack,
+    # so it is kept as (False, end_without_backtrack, end_with_backtrack)
+    memo = state.memo.get(ref)
+    if memo is None:
+        memo = state.memo[ref] = {}
+    start = state.position()
+    result = memo.get(start)
+    if result is not None:
+        # replay the earlier result
+        end = result[0]
+        if end is not False:
+            state.advance(end-start)
+            state.ast += result[1]
+            return state
+        end = result[2] if backtrack else result[1]
+        if end is not None:
+            state.advance(end-start)
+            return False
+    astlen = len(state.ast)
+    if parser(state, backtrack):
+        memo[start] = (state.position(), state.ast[astlen:])
+        return state
+    end = state.position()
+    if result is None:
+        result = (False, None, None)
+    if backtrack:
+        memo[start] = (False, result[1], end)
+    else:
+        memo[start] = (False, end, result[2])
+    return False
+
 class Ref(Parser):
-    # forward reference
-    def __init__(self):
+    # forward reference, optionally memoizing (packrat) the results 
+    # of the referenced parser
+    __slots__ = ('name', 'parser', 'memoize')
+
+    def __init__(self, memoize=False):
         self.parser = None
         self.name = None
+        self.memoize = memoize
         
     def set(self, parser):
         self.parser = parser
         
     def __call__(self, state, backtrack=False):
-        return self.parser(state, backtrack)
+        if not self.memoize:
+            return self.parser(state, backtrack)
+        return _memo_call(self, self.parser, state, backtrack)
     
     def __truediv__(self, name):
         self.name = name
@@ -380,9 +606,12 @@ class Ref(Parser):
         return self
     
 class Require(Parser):
+    __slots__ = ('name', 'parser', 'errcode')
+
     def __init__(self, required, errcode):
         self.parser = required
         self.errcode = errcode
+        self.name = 'require'
         
     def __call__(self, state, backtrack=False):
         if self.parser(state, backtrack):
@@ -390,10 +619,62 @@ class Require(Parser):
         else:
             raise RuntimeError(dict(position=state.position(), errorcode=self.errcode))
 
+def _walk(parsers):
+    # yields every parser reachable from parsers, once
+    seen = set()
+    todo = list(parsers)
+    while todo:
+        p = todo.pop()
+        if id(p) in seen:
+            continue
+        seen.add(id(p))
+        yield p
+        t = type(p)
+        if t is Seq or t is Alt:
+            todo += p.operands
+        elif (t is Repeat or t is Ref or t is Require) and p.parser is not None:
+            todo.append(p.parser)
+
+def _first(p, refs=()):
+    # returns (mode, keys) where p can only succeed if the next character
+    # (mode 'text') or token kind (mode 'token') is in keys, and fails
+    # without changing the state otherwise (except for skipping spaces). 
+    # Returns None if p might succeed or have effects on any input.
+    t = type(p)
+    if t is MatchTokenKind:
+        return ('token', {p.kind})
+    if t is Match:
+        if p.pattern:
+            return ('text', {p.pattern[0]})
+        return None
+    if t is BoolParser:
+        return None if p.value else (None, set())
+    if t is Seq:
+        return _first(p.parsers[0], refs) if p.parsers else None
+    if t is Repeat:
+        return _first(p.parser, refs) if p.n>0 else None
+    if t is Ref:
+        if p in refs or p.parser is None:
+            return None
+        return _first(p.parser, refs+(p,))
+    if t is Alt:
+        mode, keys = None, set()
+        for q in p.parsers:
+            f = _first(q, refs)
+            if f is None or (mode and f[0] and f[0]!=mode):
+                return None
+            mode = mode or f[0]
+            keys |= f[1]
+        return (mode, keys)
+    # anything else (including Require, which raises on failure) 
+    return None
+
 class Grammar(Parser):
     # something to make forward references & naming easy
     def __init__(self, p=None):
         self.__dict__['parsername'] = None
+        self.__dict__['compiled'] = None
+        self.__dict__['flattened'] = False
         
     
     def __getattr__(self, attr):
@@ -403,16 +684,312 @@ class Grammar(Parser):
     
     def __setattr__(self, attr, value):
         # create or fill in an attribute
+        if (attr in ('parsername', 'compiled', 'flattened') or 
+                hasattr(type(self), attr)):
+            raise ValueError(f'{attr} is used by Grammar, so is not a rule name')
+        if self.flattened:
+            # changing a rule undoes compile
+            self._unflatten()
         if attr in self.__dict__:
             g = getattr(self, attr)
             if type(g) is Ref:
                 g.set(value)
                 g/attr
+                if self.parsername is None:
+                    self.__dict__['parsername'] = attr
                 return
         self.__dict__[attr] = value
         value/attr
         if self.parsername is None:
             self.__dict__['parsername'] = attr
         
+    def memoize(self, *rules):
+        # switch on packrat memoization for the named rules. A rule
+        # must be a forward reference, so call this before defining
+        # any rule that isn't used before it is defined.
+        for attr in rules:
+            g = getattr(self, attr)
+            if type(g) is not Ref:
+                raise ValueError(f'rule {attr} was defined before memoize')
+            g.memoize = True
+        # the compiled functions have memoization built in, so are redone
+        self.__dict__['compiled'] = None
+        
+    def rules(self):
+        # returns a dict of the rules in the grammar
+        return {attr:value for attr, value in self.__dict__.items()
+                if attr not in ('parsername', 'compiled', 'flattened')}
+    
+    def _flatten(self):
+        # flattens the sequences and alternatives of the rules, on the
+        # first parse or compile. This is recorded first, so that a rule 
+        # changed after a failed compile still undoes it.
+        self.__dict__['flattened'] = True
+        for p in _walk(self.rules().values()):
+            if type(p) is Seq or type(p) is Alt:
+                p.flatten()
+    
+    def _unflatten(self):
+        # undoes _flatten and compile, restoring the parsers as written
+        for p in _walk(self.rules().values()):
+            if type(p) is Seq or type(p) is Alt:
+                p.parsers = p.operands
+            if type(p) is Alt:
+                p.table = None
+        self.__dict__['flattened'] = False
+        self.__dict__['compiled'] = None
+    
+    def compile(self):
+        # flattens the sequences and alternatives, builds the dispatch 
+        # tables of the alternatives, and generates python functions for 
+        # the rules, which the grammar then uses in place of the parser 
+        # objects
+        self._flatten()
+        for p in _walk(self.rules().values()):
+            if type(p) is Alt:
+                p.compile_first()
+        self.__dict__['compiled'] = _Compiler().compile(self.rules())
+        return self
+        
     def __call__(self, state, backtrack=False):
+        if self.compiled:
+            return self.compiled[self.parsername](state, backtrack)
+        if not self.flattened:
+            # the rules are named by the time they parse; changing one
+            # undoes this
+            self._flatten()
         return getattr(self, self.parsername)(state, backtrack)
+
+"""
+Compiling a grammar.
+
+Grammar.compile() turns each rule into a single python function, with 
+sequences, alternatives, repeats, and the builtin matchers written out as 
+inline code, so that a parse makes one python call per rule rather than 
+one per parser object. Other callables are called as they are. The 
+compiled functions build exactly the same ast as the parser objects. 
+Literal and regex matches assume a TextState, token matches a TokenState.
+"""
+
+class _Compiler:
+    # generates the python source for a set of rules
+    
+    MAXDEPTH = 12 # deeper parsers get their own function
+    
+    def __init__(self):
+        self.ns = {'Leaf':Leaf, '_memo_call':_memo_call}
+        self.consts = {} # id(object) -> name in ns
+        self.funcs = {} # id(parser) -> function name
+        self.todo = [] # functions still to be generated, with their rules
+        self.count = 0
+        
+    def compile(self, rules):
+        # returns a dict of compiled functions, one for each rule
+        for attr, value in rules.items():
+            self.funcs[id(value)] = '_r_'+attr
+            self.todo.append(('_r_'+attr, value, attr))
+        src = []
+        while self.todo:
+            src += self.function(*self.todo.pop())
+        exec(compile('\n'.join(src), '<grammar>', 'exec'), self.ns)
+        return {attr:self.ns['_r_'+attr] for attr in rules}
+        
+    def const(self, obj):
+        # the name of an object in the namespace of the compiled code
+        if id(obj) not in self.consts:
+            self.consts[id(obj)] = name = f'_k{len(self.consts)}'
+            self.ns[name] = obj
+        return self.consts[id(obj)]
+    
+    def literal(self, value):
+        # the source for a value
+        if type(value) in (str, bytes, int, bool):
+            return repr(value)
+        return self.const(value)
+    
+    def call(self, p):
+        # the name of the function which runs parser p
+        if id(p) not in self.funcs:
+            self.funcs[id(p)] = name = f'_f{len(self.funcs)}'
+            self.todo.append((name, p, self.rule))
+        return self.funcs[id(p)]
+        
+    def fresh(self):
+        # a new suffix for local variable names
+        self.count += 1
+        return self.count
+    
+    def function(self, name, p, rule):
+        # the source lines of a function for parser p, which is rule or a 
+        # part of it
+        self.rule = rule
+        if type(p) is Ref:
+            if p.parser is None:
+                if name=='_r_'+rule:
+                    raise ValueError(f'rule {rule} is not defined')
+                raise ValueError(f'a reference in rule {rule} is not defined')
+            if p.memoize:
+                return [f'def {name}(state, backtrack=False):',
+                        f'    return _memo_call({self.const(p)}, '
+                        f'{self.call(p.parser)}, state, backtrack)', '']
+            p = p.parser
+        out = [f'def {name}(state, backtrack=False):',
+               '    _inp = state.input']
+        self.spaces = False
+        self.inline(p, 'backtrack', 1, out)
+        if self.spaces:
+            out.insert(2, '    _sp = state.space')
+        out += ['    return state if ok else False', '']
+        return out
+    
+    def emit(self, p, bt, depth, out):
+        # appends source lines to out which run parser p and set ok,
+        # calling a function for rules, refs, and deep parsers
+        if id(p) in self.funcs or type(p) is Ref or depth>self.MAXDEPTH:
+            out.append(f'{"    "*depth}ok = {self.call(p)}(state, {bt})')
+        else:
+            self.inline(p, bt, depth, out)
+    
+    def inline(self, p, bt, depth, out):
+        # appends source lines to out which run parser p and set ok. 
+        # bt is the source of the backtrack flag (True, False or backtrack)
+        ind = '    '*depth
+        t = type(p)
+        if t is Match or t is MatchRe:
+            if p.ws:
+                # skip spaces
+                self.spaces = True
+                out += [f'{ind}p = state.pos',
+                        f'{ind}while p<len(_inp) and _inp[p]==_sp: p += 1',
+                        f'{ind}state.pos = p']
+            if t is Match:
+                if not p.pattern:
+                    # an empty match fails
+                    out.append(f'{ind}ok = False')
+                    return
+                value = self.literal(p.pattern)
+                end = f'state.pos+{p.n}'
+                out.append(f'{ind}if _inp.startswith({value}, state.pos):')
+            else:
+                n = self.fresh()
+                value = f'r{n}.group(0)'
+                end = f'r{n}.end()'
+                out += [f'{ind}r{n} = {self.const(p.re)}.match(_inp, state.pos)',
+                        f'{ind}if r{n} and {end}>state.pos:']
+            if p.save:
+                out.append(f'{ind}    state.ast.append(Leaf({self.literal(p.name)}, '
+                           f'{value}, (state.pos, {end})))')
+            out += [f'{ind}    state.pos = {end}', 
+                    f'{ind}    ok = True',
+                    f'{ind}else:',
+                    f'{ind}    ok = False']
+        elif t is MatchToken or t is MatchTokenKind or t is MatchTokenNotKind:
+            n = self.fresh()
+            # bounds checked on the list that is indexed, as in the
+            # parser objects
+            if t is MatchToken:
+                test = f'c{n}<len(_inp) and {self.const(p.predicate)}(_inp[c{n}])'
+            elif t is MatchTokenKind:
+                test = f'c{n}<len(state.kinds) and state.kinds[c{n}]=={self.literal(p.kind)}'
+            else:
+                test = f'c{n}<len(state.kinds) and state.kinds[c{n}]!={self.literal(p.kind)}'
+            out += [f'{ind}c{n} = state.cursor',
+                    f'{ind}if {test}:']
+            if p.save:
+                out.append(f'{ind}    state.ast.append(Leaf({self.literal(p.name)}, '
+                           f'_inp[c{n}], (c{n}, c{n}+1)))')
+            out += [f'{ind}    state.cursor = c{n}+1',
+                    f'{ind}    ok = True',
+                    f'{ind}else:',
+                    f'{ind}    ok = False']
+        elif t is BoolParser:
+            out.append(f'{ind}ok = {bool(p.value)}')
+        elif t is Seq or t is Repeat:
+            n = self.fresh()
+            # backtracking is done by the caller when bt is True, and
+            # isn't needed by a repeat which can't fail
+            if t is Repeat and p.n==0:
+                bt = 'True'
+            if bt=='False':
+                out.append(f'{ind}m{n} = state.mark()')
+            elif bt!='True':
+                out.append(f'{ind}if not {bt}: m{n} = state.mark()')
+            out.append(f'{ind}a{n} = len(state.ast)')
+            d = depth
+            if t is Seq:
+                if not p.parsers:
+                    out.append(f'{ind}ok = True')
+                for i, q in enumerate(p.parsers):
+                    if i==0:
+                        self.emit(q, 'True', depth, out)
+                    else:
+                        # each later parser runs only if all before it
+                        # succeeded; a block each keeps long sequences
+                        # from nesting deeply
+                        out.append(f'{ind}if ok:')
+                        self.emit(q, 'True', depth+1, out)
+            else:
+                if p.n==0:
+                    out.append(f'{ind}ok = True')
+                elif p.n==1:
+                    self.emit(p.parser, 'True', d, out)
+                else:
+                    out.append(f'{ind}ok = True')
+                    out.append(f'{ind}for _ in range({p.n}):')
+                    self.emit(p.parser, 'True', d+1, out)
+                    out.append(f'{ind}    if not ok: break')
+                if p.n>0:
+                    out.append(f'{ind}if ok:')
+                    d += 1
+                # optional repeats, each of which looks after its own backtrack
+                out.append(f'{"    "*d}while True:')
+                self.emit(p.parser, 'False', d+1, out)
+                out.append(f'{"    "*d}    if not ok: break')
+                out.append(f'{"    "*d}ok = True')
+            out += [f'{ind}if ok:',
+                    f'{ind}    state.group({self.literal(p.name)}, a{n})']
+            if bt=='False':
+                out.append(f'{ind}else:')
+                out.append(f'{ind}    state.rewind(m{n})')
+            elif bt!='True':
+                out.append(f'{ind}elif not {bt}:')
+                out.append(f'{ind}    state.rewind(m{n})')
+        elif t is Alt:
+            n = self.fresh()
+            if p.name!='alt':
+                out.append(f'{ind}a{n} = len(state.ast)')
+            out.append(f'{ind}ok = False')
+            if p.table is not None:
+                # only try the alternatives that can start with the key
+                if p.mode=='token':
+                    out.append(f'{ind}k{n} = state.kinds[state.cursor] '
+                               f'if state.cursor<len(state.kinds) else None')
+                else:
+                    # everything is tried at a space, as in Alt
+                    self.spaces = True
+                    out.append(f'{ind}k{n} = _inp[state.pos] '
+                               f'if state.pos<len(_inp) else None')
+            for q in p.parsers:
+                f = _first(q) if p.table is not None else None
+                if f is None:
+                    out.append(f'{ind}if not ok:')
+                else:
+                    keys = self.const(frozenset(k for k in p.table if q in p.table[k]))
+                    if p.mode=='text':
+                        out.append(f'{ind}if not ok and (k{n}==_sp or k{n} in {keys}):')
+                    else:
+                        out.append(f'{ind}if not ok and k{n} in {keys}:')
+                self.emit(q, 'False', depth+1, out)
+            if p.name!='alt':
+                out.append(f'{ind}if ok:')
+                out.append(f'{ind}    state.group({self.literal(p.name)}, a{n})')
+        elif t is Ref:
+            out.append(f'{ind}ok = {self.call(p)}(state, {bt})')
+        elif t is Require:
+            self.emit(p.parser, bt, depth, out)
+            out += [f'{ind}if not ok:',
+                    f'{ind}    raise RuntimeError(dict(position=state.position(), '
+                    f'errorcode={self.literal(p.errcode)}))']
+        else:
+            # any other callable is called as it is
+            out.append(f'{ind}ok = {self.const(p)}(state, {bt})')
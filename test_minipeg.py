@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+regression tests for minipeg
+"""
+
+import unittest
+from collections import namedtuple
+
+from minipeg import (Grammar, Match, MatchRe, MatchTokenKind, TextState, 
+                     TokenState)
+
+def shape(node):
+    # the names in a parse tree, as nested lists
+    if len(node)==0:
+        return node.name
+    return [node.name, [shape(c) for c in node.children]]
+
+class TestRuleNames(unittest.TestCase):
+
+    def test_rule_called_name(self):
+        g = Grammar()
+        g.top = g.name & '=' & g.value
+        g.name = MatchRe('[a-z]+')
+        g.value = MatchRe('[0-9]+')
+        s = g(TextState('abc = 12'))
+        self.assertEqual(shape(s.ast[0]), ['top', ['name', 'literal', 'value']])
+
+    def test_rule_named_after_use(self):
+        # a sequence named after it is used in another rule still
+        # makes its own node
+        for compiled in (False, True):
+            g = Grammar()
+            pair = MatchRe('[a-z]+') & ':'
+            g.item = pair & MatchRe('[0-9]+')
+            g.pair = pair
+            if compiled:
+                g.compile()
+            s = g(TextState('ab:12'))
+            self.assertEqual(shape(s.ast[0]), 
+                ['item', [['pair', ['re([a-z]+)', 'literal']], 're([0-9]+)']])
+
+    def test_flattened_on_first_parse(self):
+        # a chain runs as one sequence once the grammar parses, and a 
+        # change to a rule restores it
+        g = Grammar()
+        pair = MatchRe('[a-z]+') & ':'
+        g.item = pair & MatchRe('[0-9]+') & g.rest
+        g.rest = Match(';')
+        self.assertTrue(g(TextState('ab:12;')))
+        self.assertEqual(len(g.item.parsers), 4)
+        g.pair = pair
+        self.assertEqual(len(g.item.parsers), 2)
+        s = g(TextState('ab:12;'))
+        self.assertEqual(shape(s.ast[0]), 
+            ['item', [['pair', ['re([a-z]+)', 'literal']], 're([0-9]+)', 'rest']])
+        self.assertEqual(len(g.item.parsers), 3)
+
+    def test_rule_named_after_failed_compile(self):
+        # a failed compile is undone by the next change to a rule
+        g = Grammar()
+        pair = MatchRe('[a-z]+') & ':'
+        g.item = pair & MatchRe('[0-9]+') & g.rest
+        with self.assertRaises(ValueError):
+            g.compile()
+        g.pair = pair
+        g.rest = Match(';')
+        s = g(TextState('ab:12;'))
+        self.assertEqual(shape(s.ast[0]), 
+            ['item', [['pair', ['re([a-z]+)', 'literal']], 're([0-9]+)', 'rest']])
+
+    def test_reserved_rule_names(self):
+        g = Grammar()
+        g.top = Match('a')
+        g.compile()
+        for attr in ('rules', 'compile', 'memoize', 'compiled', 'flattened',
+                     'parsername'):
+            with self.assertRaises(ValueError):
+                setattr(g, attr, Match('a') & 'b')
+        # the grammar is still usable
+        g.other = Match('b')
+        self.assertTrue(g.compile()(TextState('a')))
+
+class TestMemoize(unittest.TestCase):
+
+    def grammar(self, memoize):
+        g = Grammar()
+        if memoize:
+            g.memoize('x')
+        g.top = (g.x & 'zz') | (g.x | Match('b', ws=False))
+        g.x = Match('a')
+        return g
+
+    def test_failure_skips_spaces(self):
+        # a failed x still skips the leading space, cached or not
+        for memoize in (False, True):
+            for compiled in (False, True):
+                g = self.grammar(memoize)
+                if compiled:
+                    g.compile()
+                s = g(TextState(' b'))
+                self.assertTrue(s, (memoize, compiled))
+                self.assertEqual(shape(s.ast[0]), ['top', ['literal']])
+
+    def test_memoize_after_compile(self):
+        # memoize discards the compiled functions, which don't memoize x
+        g = Grammar()
+        g.top = g.x & 'b'
+        g.x = Match('a')
+        g.compile()
+        g.memoize('x')
+        state = TextState('ab')
+        self.assertTrue(g(state))
+        self.assertIn(g.x, state.memo)
+
+class TestCompile(unittest.TestCase):
+
+    def test_kinds_shorter_than_input(self):
+        # token kinds are bounds checked on the kinds, compiled or not
+        for compiled in (False, True):
+            g = Grammar()
+            g.top = (MatchTokenKind(1) & MatchTokenKind(1)) | MatchTokenKind(2)
+            if compiled:
+                g.compile()
+            self.assertFalse(g(TokenState(['x', 'y'], [1])))
+            self.assertTrue(g(TokenState(['x', 'y'], [1, 1])))
+
+    def test_undefined_rule(self):
+        g = Grammar()
+        g.top = Match('a') & g.rest
+        with self.assertRaisesRegex(ValueError, 'rule rest is not defined'):
+            g.compile()
+
+    def test_long_sequence(self):
+        g = Grammar()
+        p = Match('a')
+        for i in range(199):
+            p = p & Match('a')
+        g.top = p
+        g.compile()
+        s = g(TextState('a'*200))
+        self.assertEqual(shape(s.ast[0]), ['top', ['literal']*200])
+        self.assertFalse(g(TextState('a'*199)))
+
+    def test_kinds_from_tokens(self):
+        # without kinds, a token state uses the kind attribute of the tokens
+        Token = namedtuple('Token', 'kind value')
+        for compiled in (False, True):
+            g = Grammar()
+            g.top = MatchTokenKind(1) | MatchTokenKind(2)
+            if compiled:
+                g.compile()
+            self.assertTrue(g(TokenState([Token(2, 'x')])))
+            self.assertFalse(g(TokenState([Token(3, 'x')])))
+            self.assertFalse(g(TokenState(['x'])))
+
+    def test_other_space(self):
+        # the alternatives are all tried at the state's own space
+        class TabState(TextState):
+            space = '\t'
+        for compiled in (False, True):
+            g = Grammar()
+            g.top = Match('a') | Match('b')
+            if compiled:
+                g.compile()
+            self.assertTrue(g(TabState('\tb')))
+            self.assertTrue(g(TextState(' b')))
+            self.assertFalse(g(TabState(' b')))
+
+if __name__ == '__main__':
+    unittest.main()